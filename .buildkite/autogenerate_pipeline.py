@@ -3,7 +3,8 @@
 # Copyright 2021 Amazon.com, Inc. or its affiliates. All Rights Reserved.
 # SPDX-License-Identifier: Apache-2.0 OR BSD-3-Clause
 """
-This script is printing the Buildkite pipeline.yml to stdout.
+This script is printing the Buildkite pipeline.yml to stdout. The pipeline can
+also be printed in JSON format using `--format json`.
 This can also be used as a library to print the steps from a different pipeline
 specified as a parameter to the `generate_test_pipeline`.
 
@@ -56,13 +57,31 @@ import pathlib
 import copy
 
 from argparse import ArgumentParser, RawTextHelpFormatter
+from functools import lru_cache
 from textwrap import dedent
 
+# Prefer the libyaml-backed dumper, which is considerably faster than the
+# pure-Python one, and fall back when PyYAML was built without libyaml.
+try:
+    from yaml import CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeDumper as YamlDumper
+
+
+# orjson parses the JSON from the environment variables faster than the
+# standard library, but it is an optional dependency.
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    from json import loads as _json_loads
+
 # This represents the version of the rust-vmm-container used
 # for running the tests.
 CONTAINER_VERSION = "v13"
 # This represents the version of the Buildkite Docker plugin.
 DOCKER_PLUGIN_VERSION = "v3.8.0"
+# This is the key under which the docker plugin is configured in a step.
+DOCKER_PLUGIN_KEY = f"docker#{DOCKER_PLUGIN_VERSION}"
 
 X86_AGENT_TAGS = os.getenv('X86_LINUX_AGENT_TAGS')
 AARCH64_AGENT_TAGS = os.getenv('AARCH64_LINUX_AGENT_TAGS')
@@ -73,6 +92,45 @@ TIMEOUTS_MIN = os.getenv('TIMEOUTS_MIN')
 PARENT_DIR = pathlib.Path(__file__).parent.resolve()
 
 
+# The environment variables are parsed lazily, the first time they are
+# needed, and the result is cached instead of parsing them for every step.
+@lru_cache(maxsize=None)
+def _parse_env_config(env_name, env_var):
+    """
+    Parse an environment variable holding a `tests`/`cfg` dictionary.
+    The list of tests is turned into a set for fast membership checks.
+    """
+
+    if not env_var:
+        return None
+
+    env_cfg = _json_loads(env_var)
+
+    tests = env_cfg.get('tests')
+    assert tests,\
+        f"Environment variable {env_name} is missing the `tests` key."
+
+    cfg = env_cfg.get('cfg')
+    assert cfg,\
+        f"Environment variable {env_name} is missing the `cfg` key."
+
+    return {'tests': set(tests), 'cfg': cfg}
+
+
+@lru_cache(maxsize=None)
+def _tests_to_skip():
+    """ Return the set of tests listed in `TESTS_TO_SKIP`. """
+
+    return set(_json_loads(TESTS_TO_SKIP)) if TESTS_TO_SKIP else set()
+
+
+@lru_cache(maxsize=None)
+def _timeouts_min():
+    """ Return the timeouts overridden through `TIMEOUTS_MIN`. """
+
+    return _json_loads(TIMEOUTS_MIN) if TIMEOUTS_MIN else {}
+
+
 class BuildkiteStep:
     """
     This builds a Buildkite step according to a json configuration and the
@@ -87,23 +145,20 @@ class BuildkiteStep:
         """
 
         # Default values.
-        # The order in which the attributes are initialized is the same as the
-        # order in which the keys will appear in the YAML file, because Python
-        # dictionaries are ordered. For readability reasons, this order should
-        # not be changed.
         self.label = None
         self.command = None
         self.retry = {'automatic': False}
         self.agents = {'os': 'linux'}
         self.plugins = [
             {
-                f"docker#{DOCKER_PLUGIN_VERSION}": {
+                DOCKER_PLUGIN_KEY: {
                     'image': f"rustvmm/dev:{CONTAINER_VERSION}",
                     'always-pull': True
                 }
             }
         ]
         self.timeout_in_minutes = 5
+        self.conditional = None
 
     def _set_platform(self, platform):
         """ Set platform if given in the json input. """
@@ -119,38 +174,29 @@ class BuildkiteStep:
         """ Set conditional if given in the json input. """
 
         if conditional:
-            setattr(self, 'if', conditional)
+            self.conditional = conditional
 
     def _add_docker_config(self, cfg):
         """ Add configuration for docker if given in the json input. """
 
         if cfg:
-            target = self.plugins[0][f"docker#{DOCKER_PLUGIN_VERSION}"]
+            target = self.plugins[0][DOCKER_PLUGIN_KEY]
+            # Steps must not share objects with each other, otherwise the
+            # YAML output gets anchors and aliases.
             for key, val in cfg.items():
-                target[key] = val
+                target[key] = copy.deepcopy(val)
 
-    def _env_change_config(self, test_name, env_var, target, override=False):
+    def _env_change_config(self, test_name, env_cfg, target, override=False):
         """
         Helper function to add to/override configuration of `target`
-        if `env_var` is set and this test appears in its list.
+        if `env_cfg` is set and this test appears in its list.
         """
 
-        if env_var:
-            env_cfg = json.loads(env_var)
-
-            tests = env_cfg.get('tests')
-            assert tests,\
-                f"Environment variable {env_var} is missing the `tests` key."
-
-            cfg = env_cfg.get('cfg')
-            assert cfg,\
-                f"Environment variable {env_var} is missing the `cfg` key."
-
-            if test_name in tests:
-                if override:
-                    target.clear()
-                for key, val in cfg.items():
-                    target[key] = val
+        if env_cfg and test_name in env_cfg['tests']:
+            if override:
+                target.clear()
+            for key, val in env_cfg['cfg'].items():
+                target[key] = copy.deepcopy(val)
 
     def _env_override_agent_tags(self, test_name):
         """
@@ -159,19 +205,21 @@ class BuildkiteStep:
         environment variables.
         """
 
-        env_var = None
+        env_cfg = None
         platform = self.agents.get('platform')
 
         # Since the platform is optional, only override the config if the
         # platform was provided.
         if platform:
-            if platform == 'x86_64.metal' and X86_AGENT_TAGS:
-                env_var = X86_AGENT_TAGS
-            if platform == 'arm.metal' and AARCH64_AGENT_TAGS:
-                env_var = AARCH64_AGENT_TAGS
+            if platform == 'x86_64.metal':
+                env_cfg = _parse_env_config('X86_LINUX_AGENT_TAGS',
+                                            X86_AGENT_TAGS)
+            if platform == 'arm.metal':
+                env_cfg = _parse_env_config('AARCH64_LINUX_AGENT_TAGS',
+                                            AARCH64_AGENT_TAGS)
 
         target = self.agents
-        self._env_change_config(test_name, env_var, target, override=True)
+        self._env_change_config(test_name, env_cfg, target, override=True)
 
     def _env_add_docker_config(self, test_name):
         """
@@ -179,34 +227,32 @@ class BuildkiteStep:
         `DOCKER_PLUGIN_CONFIG` environment variable.
         """
 
-        target = self.plugins[0][f"docker#{DOCKER_PLUGIN_VERSION}"]
-        self._env_change_config(test_name, DOCKER_PLUGIN_CONFIG, target)
+        target = self.plugins[0][DOCKER_PLUGIN_KEY]
+        env_cfg = _parse_env_config('DOCKER_PLUGIN_CONFIG',
+                                    DOCKER_PLUGIN_CONFIG)
+        self._env_change_config(test_name, env_cfg, target)
 
     def _env_override_timeout(self, test_name):
-        if TIMEOUTS_MIN:
-            timeouts_min = json.loads(TIMEOUTS_MIN)
-            if test_name in timeouts_min:
-                self.timeout_in_minutes = timeouts_min[test_name]
+        timeouts_min = _timeouts_min()
+        if test_name in timeouts_min:
+            self.timeout_in_minutes = timeouts_min[test_name]
 
-    def build(self, input):
+    def build(self, test_name, command, platform=None, docker=None,
+              conditional=None):
         """
-        Build a Buildkite step using the `input` configuration that must
-        specify some mandatory keys and can also provide optional ones.
-        Further configuration from environment variables may be added.
+        Build a Buildkite step from the values of a test configuration.
+        The `test_name` and `command` are mandatory, while the other values
+        are optional. Further configuration from environment variables may
+        be added.
         """
 
-        test_name = input.get('test_name')
-        command = input.get('command')
-        platform = input.get('platform')
-        docker = input.get('docker_plugin')
-        conditional = input.get('conditional')
-
         # Mandatory keys.
         assert test_name, "Step is missing test name."
+        assert command, "Step is missing command."
+
         platform_string = f"-{platform}" if platform else ""
         self.label = f"{test_name}{platform_string}"
 
-        assert command, "Step is missing command."
         if "{target_platform}" in command:
             assert platform,\
                 "Command requires platform, but platform is missing."
@@ -225,8 +271,21 @@ class BuildkiteStep:
         self._env_add_docker_config(test_name)
         self._env_override_timeout(test_name)
 
-        # Return the object's attributes and their values as a dictionary.
-        return vars(self)
+        # The keys are listed in the order in which they will appear in the
+        # YAML file, because Python dictionaries are ordered. For readability
+        # reasons, this order should not be changed.
+        step = {
+            'label': self.label,
+            'command': self.command,
+            'retry': self.retry,
+            'agents': self.agents,
+            'plugins': self.plugins,
+            'timeout_in_minutes': self.timeout_in_minutes,
+        }
+        if self.conditional:
+            step['if'] = self.conditional
+
+        return step
 
 
 class BuildkiteConfig:
@@ -236,6 +295,11 @@ class BuildkiteConfig:
     be put into yaml format by the pyyaml package.
     """
 
+    def __init__(self):
+        """ Initialize a Buildkite configuration without any steps. """
+
+        self.steps = []
+
     def build(self, input):
         """ Build the final Buildkite configuration fron the json input. """
 
@@ -244,41 +308,51 @@ class BuildkiteConfig:
         assert tests, "Input is missing list of tests."
 
         for test in tests:
-            platforms = test.get('platform')
             test_name = test.get('test_name')
 
-            if TESTS_TO_SKIP:
-                tests_to_skip = json.loads(TESTS_TO_SKIP)
-                if test_name in tests_to_skip:
-                    continue
+            if test_name in _tests_to_skip():
+                continue
+
+            command = test.get('command')
+            platforms = test.get('platform')
+            docker = test.get('docker_plugin')
+            conditional = test.get('conditional')
 
             # The platform is optional. When it is not specified, we don't add
             # it to the step so that we can run the test in any environment.
-            if not platforms:
-                platforms = [None]
-
-            for platform in platforms:
-                step_input = copy.deepcopy(test)
-                step_input['platform'] = platform
-
+            # Only the platform differs between the steps of a test, so the
+            # other values are looked up once per test.
+            for platform in platforms or (None,):
                 step = BuildkiteStep()
-                step_output = step.build(step_input)
+                step_output = step.build(test_name, command, platform, docker,
+                                         conditional)
                 self.steps.append(step_output)
 
         # Return the object's attributes and their values as a dictionary.
         return vars(self)
 
 
-def generate_pipeline(config_file):
-    """ Generate the pipeline yaml file from a json configuration file. """
+def generate_pipeline(config_file, output_format='yaml'):
+    """
+    Generate the pipeline from a json configuration file. The pipeline is
+    printed in YAML format by default, or in JSON format when
+    `output_format` is `json`.
+    """
 
     with open(config_file) as json_file:
         json_cfg = json.load(json_file)
-        json_file.close()
 
+    # All the steps are built, and thus validated, before anything is
+    # printed so that an invalid configuration never results in a partial
+    # pipeline being uploaded.
     config = BuildkiteConfig()
     output = config.build(json_cfg)
-    yaml.dump(output, sys.stdout, sort_keys=False)
+    if output_format == 'json':
+        json.dump(output, sys.stdout, separators=(',', ':'))
+        sys.stdout.write('\n')
+    else:
+        yaml.dump(output, sys.stdout, Dumper=YamlDumper, sort_keys=False,
+                  default_flow_style=False)
 
 
 if __name__ == '__main__':
@@ -309,5 +383,11 @@ if __name__ == '__main__':
                         help='The path to the JSON file containing the test'
                              ' description for the CI.',
                         default=f'{PARENT_DIR}/test_description.json')
+    # `buildkite-agent pipeline upload` accepts both YAML and JSON. Emitting
+    # JSON is faster, while YAML is kept as the default for readability.
+    parser.add_argument('-f', '--format',
+                        choices=['yaml', 'json'],
+                        help='The format in which the pipeline is printed.',
+                        default='yaml')
     args = parser.parse_args()
-    generate_pipeline(args.test_description)
+    generate_pipeline(args.test_description, args.format)